@@ -1,16 +1,30 @@
 # app.py
+# patch sockets/threading before anything imports them, so requests and telebot yield to the hub
+import eventlet
+eventlet.monkey_patch()
+
 import os
 import sqlite3
 import json
 import logging
-from time import time
-from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, url_for
+import random
+from time import time, gmtime, strftime
+from flask import Flask, request, jsonify, send_from_directory, url_for, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_socketio import SocketIO
 import telebot
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
 
 # --------- Configuration (environment overrides) ----------
+_TRUTHY = frozenset(("1", "true", "yes"))
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    return default if value is None else value.lower() in _TRUTHY
+
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8033069276:AAFv1-kdQ68LjvLEgLHj3ZXd5ehMqyUXOYU")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "6482440657"))
 REQUIRED_CHANNEL = os.environ.get("REQUIRED_CHANNEL", "@ReviewCashNews")
@@ -18,13 +32,66 @@ WEBAPP_URL = os.environ.get("WEBAPP_URL", "https://web-production-398fb.up.railw
 DB_PATH = os.environ.get("DB_PATH", "data.db")
 HOST = os.environ.get("HOST", "0.0.0.0")
 PORT = int(os.environ.get("PORT", 8080))
-USE_WEBHOOK_ON_START = True
+# opt-in: faster commits, but a power loss may drop the last committed transactions
+SQLITE_SYNC_NORMAL = env_flag("SQLITE_SYNC_NORMAL")
+WEBHOOK_URL = WEBAPP_URL.rstrip("/") + "/bot"
+USE_WEBHOOK_ON_START = env_flag("USE_WEBHOOK_ON_START", True)
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", 5))
+WEBHOOK_BASE_BACKOFF = float(os.environ.get("WEBHOOK_BASE_BACKOFF_SECONDS", 3))
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", 4))
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 4))
 
 # --------- App init ----------
+# int/float/... dict keys are written as strings, like the stdlib encoder does
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+class ORJSONProvider(DefaultJSONProvider):
+    # orjson output is always compact UTF-8 with keys in insertion order; callers asking for
+    # anything else (indent, sort_keys, separators, cls, ...) get the stdlib encoder instead
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS), mimetype=self.mimetype)
+
+class ORJSONSocketIO:
+    # json module stand-in for python-socketio/engineio packets; they expect str and pass
+    # separators=(",", ":"), which is orjson's layout anyway; any other option goes to stdlib json
+    @staticmethod
+    def dumps(obj, **kwargs):
+        options = dict(kwargs)
+        if options.pop("separators", (",", ":")) == (",", ":") and not options:
+            return orjson.dumps(obj, option=ORJSON_OPTIONS).decode()
+        return json.dumps(obj, **kwargs)
+
+    @staticmethod
+    def loads(s, **kwargs):
+        if kwargs:
+            return json.loads(s, **kwargs)
+        return orjson.loads(s)
+
 app = Flask(__name__, static_folder="static", static_url_path="")
+app.json = ORJSONProvider(app)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "reviewcash_secret")
+# static files: let browsers reuse them for a while instead of revalidating on every load;
+# behind a web server that honours X-Sendfile, USE_X_SENDFILE=1 hands it the file body
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = int(os.environ.get("STATIC_MAX_AGE", 300))
+app.config["USE_X_SENDFILE"] = env_flag("USE_X_SENDFILE")
 CORS(app, resources={r"/api/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet", json=ORJSONSocketIO)
+
+# one keep-alive connection pool to api.telegram.org shared by every bot call
+tg_session = requests.Session()
+tg_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+telebot.apihelper.session = tg_session
 
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 
@@ -33,13 +100,30 @@ logger = logging.getLogger("reviewcash")
 
 # --------- DB helpers ----------
 def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    # one connection per app context (request, bot update), shared by every helper it calls;
+    # helpers never close it and (ensure_user aside) never commit, so a route's writes land together
+    conn = g.get("db")
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        if SQLITE_SYNC_NORMAL:
+            # with WAL, NORMAL only fsyncs at checkpoints instead of on every commit
+            conn.execute("PRAGMA synchronous=NORMAL")
+        g.db = conn
     return conn
 
+@app.teardown_appcontext
+def release_db(exc):
+    # closing without commit discards whatever a failed handler left uncommitted
+    conn = g.pop("db", None)
+    if conn is not None:
+        conn.close()
+
 def init_db():
     conn = get_db()
     cur = conn.cursor()
+    # write-ahead log: commits append to data.db-wal instead of rewriting pages in place
+    cur.execute("PRAGMA journal_mode=WAL")
     # users
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -98,48 +182,141 @@ def init_db():
         status TEXT DEFAULT 'pending',
         created_at TEXT
     )""")
+    # per-user history lookups (profile): uid -> newest rows without a table scan
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_topups_uid ON topups (uid, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_withdraws_uid ON withdraws (uid, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_worker ON submissions (worker_uid, id)")
     conn.commit()
-    conn.close()
 
-init_db()
+with app.app_context():
+    init_db()
 
 # --------- utilities ----------
 def ensure_user(uid, first_name=None, last_name=None, username=None):
+    """Create the user if missing and return its row as a dict.
+
+    Commits its own write, so call it before the caller starts writing.
+    """
     conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE id = ?", (uid,))
     row = cur.fetchone()
     if row:
-        # maybe update names
-        if first_name or last_name or username:
-            cur.execute("UPDATE users SET first_name=?, last_name=?, username=? WHERE id=?",
-                        (first_name or row["first_name"], last_name or row["last_name"], username or row["username"], uid))
+        user = dict(row)
+        # maybe update names (only write when something actually changed)
+        names = (first_name or row["first_name"], last_name or row["last_name"], username or row["username"])
+        if names != (row["first_name"], row["last_name"], row["username"]):
+            cur.execute("UPDATE users SET first_name=?, last_name=?, username=? WHERE id=?", names + (uid,))
             conn.commit()
-        conn.close()
-        return
+            invalidate_cache("users")
+            user["first_name"], user["last_name"], user["username"] = names
+        return user
     cur.execute("INSERT INTO users (id, first_name, last_name, username, balance) VALUES (?,?,?,?,?)",
-                (uid, first_name, last_name, username, 0))
+                (uid, first_name, last_name, username, 0.0))
     conn.commit()
-    conn.close()
-
-def get_user(uid):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id = ?", (uid,))
-    row = cur.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    invalidate_cache("users")
+    # same shape as a row read back later: balance is a REAL column, role has its schema default
+    return {"id": uid, "first_name": first_name, "last_name": last_name, "username": username, "balance": 0.0, "role": "user"}
 
 def change_balance(uid, delta):
     conn = get_db()
     cur = conn.cursor()
+    # part of the caller's transaction: the caller commits and drops the "users" cache
     cur.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (delta, uid))
-    conn.commit()
     cur.execute("SELECT balance FROM users WHERE id = ?", (uid,))
     r = cur.fetchone()
-    conn.close()
     return r["balance"] if r else None
 
+_iso_second = (None, "")
+
+def utc_now_iso():
+    """UTC timestamp in datetime.isoformat() layout; the date/time part is formatted once per second."""
+    global _iso_second
+    now = time()
+    sec = int(now)
+    if sec != _iso_second[0]:
+        _iso_second = (sec, strftime("%Y-%m-%dT%H:%M:%S", gmtime(sec)))
+    return "%s.%06d" % (_iso_second[1], int((now - sec) * 1000000))
+
+# values derived from a single table (serialized list bodies, aggregates), grouped by that table;
+# every writer drops the groups of the tables it touched
+_response_cache = {}
+
+def cached(table, key, build):
+    entries = _response_cache.setdefault(table, {})
+    value = entries.get(key)
+    if value is None:
+        value = build()
+        entries[key] = value
+    return value
+
+# bumped on every invalidation; with the boot epoch it names a cached body for ETag/304
+_cache_epoch = "%x" % int(time())
+_cache_versions = {}
+
+def cached_json(table, key, build):
+    body, etag = cached(table, key, lambda: (orjson.dumps(build()), "%s-%s-%s-%d" % (_cache_epoch, table, key, _cache_versions.get(table, 0))))
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag, weak=True)
+    # answers 304 with no body when the client's If-None-Match still matches
+    return response.make_conditional(request)
+
+def invalidate_cache(*tables):
+    for table in tables:
+        _response_cache.pop(table, None)
+        _cache_versions[table] = _cache_versions.get(table, 0) + 1
+
+NOTIFY_MAX_ATTEMPTS = 3
+
+def send_message_safe(chat_id, text):
+    for attempt in range(NOTIFY_MAX_ATTEMPTS):
+        last = attempt == NOTIFY_MAX_ATTEMPTS - 1
+        try:
+            bot.send_message(chat_id, text)
+            return
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 429 and e.error_code < 500:
+                logger.warning("send_message to %s failed: %s", chat_id, e)
+                return
+            logger.warning("send_message to %s failed (attempt %s): %s", chat_id, attempt + 1, e)
+            if not last:
+                # on 429 Telegram says how long to back off; 5xx gets the exponential wait
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after") if e.error_code == 429 else None
+                eventlet.sleep(retry_after or 2 ** attempt)
+        except requests.exceptions.ConnectionError as e:
+            # failing to connect is safe to resend; read timeouts and other errors may come
+            # after Telegram accepted the message, so they are not retried (no duplicates)
+            logger.warning("send_message to %s failed (attempt %s): %s", chat_id, attempt + 1, e)
+            if not last:
+                eventlet.sleep(2 ** attempt)
+        except Exception as e:
+            logger.warning("send_message to %s failed: %s", chat_id, e)
+            return
+    logger.error("send_message to %s dropped after %s attempts", chat_id, NOTIFY_MAX_ATTEMPTS)
+
+# Telegram round-trips are drained by background workers so HTTP responses don't wait for them;
+# several workers let a burst of notifications (or one rate-limited chat) not hold up the rest
+notify_queue = eventlet.Queue()
+
+def notify_worker():
+    while True:
+        chat_id, text = notify_queue.get()
+        send_message_safe(chat_id, text)
+
+for _ in range(NOTIFY_WORKERS):
+    eventlet.spawn_n(notify_worker)
+
+def notify_admin(text):
+    notify_queue.put((ADMIN_ID, text))
+
+def notify_user(uid, text):
+    # only numeric uids are Telegram chat ids
+    try:
+        chat_id = int(uid)
+    except (TypeError, ValueError):
+        return
+    notify_queue.put((chat_id, text))
+
 # --------- static routes ----------
 @app.route("/")
 def index():
@@ -163,6 +340,7 @@ TASK_TYPES = [
     {"id":"gmaps_review", "name":"Отзыв — Google Maps", "creator_price":65, "worker_price":50, "max_qty":500},
     {"id":"tg_sub", "name":"Подписка — Telegram канал", "creator_price":10, "worker_price":5, "max_qty":100000}
 ]
+TASK_TYPES_BY_ID = {t["id"]: t for t in TASK_TYPES}
 
 @app.get("/api/task_types")
 def api_task_types():
@@ -175,8 +353,7 @@ def api_profile_me():
     if not uid:
         return jsonify({"ok": False, "errmsg":"no uid"}), 400
     # ensure exists
-    ensure_user(uid)
-    user = get_user(uid)
+    user = ensure_user(uid)
     # include recent history: last 8 submissions/topups/withdraws
     conn = get_db()
     cur = conn.cursor()
@@ -186,21 +363,25 @@ def api_profile_me():
     withdraws = [dict(x) for x in cur.fetchall()]
     cur.execute("SELECT * FROM submissions WHERE worker_uid=? ORDER BY id DESC LIMIT 8", (uid,))
     subs = [dict(x) for x in cur.fetchall()]
-    conn.close()
     user_data = user.copy()
-    user_data["history"] = topups + withdraws + subs
+    history = topups + withdraws + subs
+    # ISO timestamps order correctly as plain strings
+    history.sort(key=lambda item: item["created_at"] or "", reverse=True)
+    user_data["history"] = history
     return jsonify({"ok": True, "user": user_data})
 
 # --------- Tasks list ----------
 @app.get("/api/tasks/list")
 def api_tasks_list():
+    return cached_json("tasks", "list", load_tasks_list)
+
+def load_tasks_list():
     conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT * FROM tasks WHERE status='active' OR status='inactive' ORDER BY id DESC")
     rows = cur.fetchall()
     tasks = [dict(r) for r in rows]
-    conn.close()
-    return jsonify({"ok": True, "tasks": tasks})
+    return {"ok": True, "tasks": tasks}
 
 # Create task: will deduct (reserve) total from owner's balance
 @app.post("/api/tasks/create")
@@ -211,13 +392,12 @@ def api_tasks_create():
         return jsonify({"ok": False, "errmsg":"missing fields"}), 400
     owner_uid = str(data["owner_uid"])
     qty = int(data["qty"])
-    ttype = next((x for x in TASK_TYPES if x["id"] == data["type_id"]), None)
+    ttype = TASK_TYPES_BY_ID.get(data["type_id"])
     if not ttype:
         return jsonify({"ok": False, "errmsg":"invalid type"}), 400
     creator_unit_price = float(ttype["creator_price"])
     total = creator_unit_price * qty
-    ensure_user(owner_uid)
-    user = get_user(owner_uid)
+    user = ensure_user(owner_uid)
     if user["balance"] < total:
         return jsonify({"ok": False, "errmsg":"insufficient_balance"}), 400
     # debit owner's balance (reserve)
@@ -228,12 +408,12 @@ def api_tasks_create():
     cur.execute("""
       INSERT INTO tasks (owner_uid,title,description,qty,unit_price,type_id,url,created_at)
       VALUES (?,?,?,?,?,?,?,?)
-    """, (owner_uid, data["title"], data["description"], qty, creator_unit_price, data["type_id"], data.get("url",""), datetime.utcnow().isoformat()))
+    """, (owner_uid, data["title"], data["description"], qty, creator_unit_price, data["type_id"], data.get("url",""), utc_now_iso()))
     conn.commit()
     task_id = cur.lastrowid
     cur.execute("SELECT * FROM tasks WHERE id=?", (task_id,))
     task = dict(cur.fetchone())
-    conn.close()
+    invalidate_cache("tasks", "users")
     # notify
     socketio.emit("task_update", {"task": task}, broadcast=True)
     return jsonify({"ok": True, "task": task})
@@ -252,79 +432,76 @@ def api_tasks_claim():
     cur.execute("SELECT * FROM tasks WHERE id=?", (int(task_id),))
     task = cur.fetchone()
     if not task:
-        conn.close()
         return jsonify({"ok": False, "errmsg":"task not found"}), 404
     if task["status"] != "active":
-        conn.close()
         return jsonify({"ok": False, "errmsg":"task not active"}), 400
     # create submission
     cur.execute("""
       INSERT INTO submissions (task_id, worker_uid, url, created_at, status)
       VALUES (?,?,?,?,?)
-    """, (task["id"], worker_uid, evidence_url, datetime.utcnow().isoformat(), "pending"))
+    """, (task["id"], worker_uid, evidence_url, utc_now_iso(), "pending"))
     conn.commit()
     sub_id = cur.lastrowid
     cur.execute("SELECT * FROM submissions WHERE id=?", (sub_id,))
     sub = dict(cur.fetchone())
-    conn.close()
+    invalidate_cache("submissions")
     # notify moderator via bot
-    try:
-        bot.send_message(ADMIN_ID, f"Новая заявка на проверку (task:{task['id']}) от {worker_uid}. Посмотреть: {WEBAPP_URL}/moderator")
-    except Exception:
-        pass
+    notify_admin(f"Новая заявка на проверку (task:{task['id']}) от {worker_uid}. Посмотреть: {WEBAPP_URL}/moderator")
     socketio.emit("new_submission", {"submission": sub}, broadcast=True)
     return jsonify({"ok": True, "submission": sub})
 
 # Moderator: list pending submissions
 @app.get("/api/moderator/submissions")
 def api_moderator_submissions():
+    # task title/type/owner never change after creation, so only submission writes invalidate this
+    return cached_json("submissions", "pending", load_pending_submissions)
+
+def load_pending_submissions():
     conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT s.*, t.title, t.type_id, t.owner_uid FROM submissions s LEFT JOIN tasks t ON s.task_id = t.id WHERE s.status='pending' ORDER BY s.id DESC")
     items = [dict(x) for x in cur.fetchall()]
-    conn.close()
-    return jsonify({"ok": True, "items": items})
+    return {"ok": True, "items": items}
 
 # Moderator approves submission -> credit worker by worker_price; increment task completed_qty; mark submission approved
 @app.post("/api/moderator/submissions/<int:sub_id>/approve")
 def api_moderator_approve(sub_id):
     moderator_id = request.json.get("moderator_id") if request.json else None
     conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM submissions WHERE id=?", (sub_id,))
+    # submission and its task in one lookup
+    cur.execute("""
+      SELECT s.worker_uid, s.status, t.id AS task_id, t.title, t.type_id, t.unit_price
+      FROM submissions s LEFT JOIN tasks t ON s.task_id = t.id WHERE s.id=?
+    """, (sub_id,))
     sub = cur.fetchone()
     if not sub:
-        conn.close(); return jsonify({"ok": False, "errmsg":"not found"}), 404
+        return jsonify({"ok": False, "errmsg":"not found"}), 404
     if sub["status"] != "pending":
-        conn.close(); return jsonify({"ok": False, "errmsg":"already processed"}), 400
-    cur.execute("SELECT * FROM tasks WHERE id=?", (sub["task_id"],))
-    task = cur.fetchone()
-    if not task:
-        conn.close(); return jsonify({"ok": False, "errmsg":"task not found"}), 404
+        return jsonify({"ok": False, "errmsg":"already processed"}), 400
+    if sub["task_id"] is None:
+        return jsonify({"ok": False, "errmsg":"task not found"}), 404
+    task = {"id": sub["task_id"], "title": sub["title"]}
     # find worker_price for task.type_id
-    ttype = next((x for x in TASK_TYPES if x["id"] == task["type_id"]), None)
-    worker_reward = float(ttype["worker_price"]) if ttype else float(task["unit_price"])
+    ttype = TASK_TYPES_BY_ID.get(sub["type_id"])
+    worker_reward = float(ttype["worker_price"]) if ttype else float(sub["unit_price"])
     # credit worker
     ensure_user(sub["worker_uid"])
     change_balance(sub["worker_uid"], worker_reward)
-    # increment completed_qty
-    cur.execute("UPDATE tasks SET completed_qty = completed_qty + 1 WHERE id=?", (task["id"],))
+    # increment completed_qty; if completed >= qty -> set task inactive
+    cur.execute("""
+      UPDATE tasks SET completed_qty = completed_qty + 1,
+        status = CASE WHEN completed_qty + 1 >= qty THEN 'inactive' ELSE status END
+      WHERE id=?
+    """, (task["id"],))
     # mark submission approved
     cur.execute("UPDATE submissions SET status=?, moderator_id=?, note=? WHERE id=?", ("approved", moderator_id or "", request.json.get("note",""), sub_id))
-    # if completed >= qty -> set task inactive
-    cur.execute("SELECT completed_qty, qty FROM tasks WHERE id=?", (task["id"],))
-    tnow = cur.fetchone()
-    if tnow and tnow["completed_qty"] >= tnow["qty"]:
-        cur.execute("UPDATE tasks SET status='inactive' WHERE id=?", (task["id"],))
     conn.commit()
-    conn.close()
+    invalidate_cache("tasks", "submissions", "users")
     # notify sockets and involved users
     socketio.emit("submission_update", {"submission_id": sub_id, "status":"approved"}, broadcast=True)
     socketio.emit("task_update", {"task_id": task["id"]}, broadcast=True)
     # notify worker via bot (if chat id numeric)
-    try:
-        bot.send_message(int(sub["worker_uid"]), f"Ваша работа по заданию {task['title']} подтверждена. +{worker_reward} ₽ на баланс.")
-    except Exception:
-        pass
+    notify_user(sub["worker_uid"], f"Ваша работа по заданию {task['title']} подтверждена. +{worker_reward} ₽ на баланс.")
     return jsonify({"ok": True})
 
 # Moderator rejects
@@ -336,15 +513,26 @@ def api_moderator_reject(sub_id):
     cur.execute("SELECT * FROM submissions WHERE id=?", (sub_id,))
     sub = cur.fetchone()
     if not sub:
-        conn.close(); return jsonify({"ok": False, "errmsg":"not found"}), 404
+        return jsonify({"ok": False, "errmsg":"not found"}), 404
     if sub["status"] != "pending":
-        conn.close(); return jsonify({"ok": False, "errmsg":"already processed"}), 400
+        return jsonify({"ok": False, "errmsg":"already processed"}), 400
     cur.execute("UPDATE submissions SET status=?, moderator_id=?, note=? WHERE id=?", ("rejected", moderator_id or "", note, sub_id))
-    conn.commit(); conn.close()
+    conn.commit()
+    invalidate_cache("submissions")
     socketio.emit("submission_update", {"submission_id": sub_id, "status":"rejected"}, broadcast=True)
     return jsonify({"ok": True})
 
 # --------- Topup APIs ----------
+PAY_LINK = "https://www.tbank.ru/cf/AjpqOu4cEzU"
+_qr_url = None
+
+def topup_qr_url():
+    # the static qr.png does not change while the process runs, resolve it once
+    global _qr_url
+    if _qr_url is None:
+        _qr_url = url_for("static_files", filename="qr.png") if os.path.exists(os.path.join(app.static_folder,"qr.png")) else ""
+    return _qr_url
+
 @app.post("/api/user/topup-link")
 def api_topup_link():
     data = request.json or {}
@@ -355,10 +543,11 @@ def api_topup_link():
     manual_code = f"RC-{topup_id}"
     conn = get_db(); cur = conn.cursor()
     cur.execute("INSERT INTO topups (id, uid, amount, manual_code, status, created_at) VALUES (?,?,?,?,?,?)",
-                (topup_id, uid, float(amount), manual_code, "pending", datetime.utcnow().isoformat()))
-    conn.commit(); conn.close()
-    pay_link = "https://www.tbank.ru/cf/AjpqOu4cEzU"
-    qr_url = url_for("static_files", filename="qr.png") if os.path.exists(os.path.join(app.static_folder,"qr.png")) else ""
+                (topup_id, uid, float(amount), manual_code, "pending", utc_now_iso()))
+    conn.commit()
+    invalidate_cache("topups")
+    pay_link = PAY_LINK
+    qr_url = topup_qr_url()
     # notify admin via socket
     socketio.emit("new_topup", {"id": topup_id, "uid": uid, "amount": amount}, broadcast=True)
     return jsonify({"ok": True, "id": topup_id, "manual_code": manual_code, "pay_link": pay_link, "qr_url": qr_url})
@@ -373,13 +562,9 @@ def api_topup_confirm():
     cur.execute("SELECT * FROM topups WHERE id=?", (int(topup_id),))
     t = cur.fetchone()
     if not t:
-        conn.close(); return jsonify({"ok": False, "errmsg":"not found"}), 404
+        return jsonify({"ok": False, "errmsg":"not found"}), 404
     # notify admin via bot (manual verification)
-    try:
-        bot.send_message(ADMIN_ID, f"Пополнение ожидает проверки\nID:{t['id']}\nUID:{uid}\nСумма:{t['amount']} ₽")
-    except Exception:
-        pass
-    conn.close()
+    notify_admin(f"Пополнение ожидает проверки\nID:{t['id']}\nUID:{uid}\nСумма:{t['amount']} ₽")
     return jsonify({"ok": True})
 
 # Admin confirms topup -> mark paid and credit user
@@ -390,18 +575,31 @@ def api_admin_topup_approve(topup_id):
     cur.execute("SELECT * FROM topups WHERE id=?", (topup_id,))
     t = cur.fetchone()
     if not t:
-        conn.close(); return jsonify({"ok": False, "errmsg":"not found"}), 404
-    cur.execute("UPDATE topups SET status='paid' WHERE id=?", (topup_id,))
-    change_balance(t["uid"], float(t["amount"]))
-    conn.commit(); conn.close()
-    socketio.emit("user_update", {"user_id": t["uid"], "balance": get_user(t["uid"])["balance"]}, broadcast=True)
+        return jsonify({"ok": False, "errmsg":"not found"}), 404
+    # topup-link accepts any uid; make sure there is a row to credit before writing
+    ensure_user(t["uid"])
+    # only a pending topup may be credited, so a repeated approve is a no-op
+    cur.execute("UPDATE topups SET status='paid' WHERE id=? AND status='pending'", (topup_id,))
+    if cur.rowcount == 0:
+        return jsonify({"ok": False, "errmsg":"already processed"}), 400
+    balance = change_balance(t["uid"], float(t["amount"]))
+    conn.commit()
+    invalidate_cache("topups", "users")
+    socketio.emit("user_update", {"user_id": t["uid"], "balance": balance}, broadcast=True)
     return jsonify({"ok": True})
 
 @app.post("/api/admin/topups/<int:topup_id>/reject")
 def api_admin_topup_reject(topup_id):
     conn = get_db(); cur = conn.cursor()
-    cur.execute("UPDATE topups SET status='refunded' WHERE id=?", (topup_id,))
-    conn.commit(); conn.close()
+    cur.execute("SELECT id FROM topups WHERE id=?", (topup_id,))
+    if not cur.fetchone():
+        return jsonify({"ok": False, "errmsg":"not found"}), 404
+    # a paid topup was already credited; refunding it here would not reverse the balance
+    cur.execute("UPDATE topups SET status='refunded' WHERE id=? AND status='pending'", (topup_id,))
+    if cur.rowcount == 0:
+        return jsonify({"ok": False, "errmsg":"already processed"}), 400
+    conn.commit()
+    invalidate_cache("topups")
     return jsonify({"ok": True})
 
 # --------- Withdraw flow ----------
@@ -413,22 +611,19 @@ def api_user_withdraw():
     name = data.get("name"); details = data.get("details")
     if not uid or amount <= 0 or not name or not details:
         return jsonify({"ok": False, "errmsg":"missing"}), 400
-    ensure_user(uid)
-    user = get_user(uid)
+    user = ensure_user(uid)
     if user["balance"] < amount:
         return jsonify({"ok": False, "errmsg":"insufficient_balance"}), 400
     wid = int(time()*1000)
     conn = get_db(); cur = conn.cursor()
     cur.execute("INSERT INTO withdraws (id, uid, amount, name, details, status, created_at) VALUES (?,?,?,?,?,?,?)",
-                (wid, uid, amount, name, details, "pending", datetime.utcnow().isoformat()))
+                (wid, uid, amount, name, details, "pending", utc_now_iso()))
     # debit immediately (reserve)
     change_balance(uid, -amount)
-    conn.commit(); conn.close()
+    conn.commit()
+    invalidate_cache("withdraws", "users")
     # notify admin via bot
-    try:
-        bot.send_message(ADMIN_ID, f"Новая заявка на вывод\nID:{wid}\nUID:{uid}\nСумма:{amount} ₽\nПолучатель:{name}\nРеквизиты:{details}")
-    except Exception:
-        pass
+    notify_admin(f"Новая заявка на вывод\nID:{wid}\nUID:{uid}\nСумма:{amount} ₽\nПолучатель:{name}\nРеквизиты:{details}")
     socketio.emit("new_withdraw", {"id": wid, "uid": uid, "amount": amount}, broadcast=True)
     return jsonify({"ok": True, "withdraw": {"id": wid}})
 
@@ -440,9 +635,13 @@ def api_admin_withdraws_approve(w_id):
     cur.execute("SELECT * FROM withdraws WHERE id=?", (w_id,))
     w = cur.fetchone()
     if not w:
-        conn.close(); return jsonify({"ok": False, "errmsg":"not found"}), 404
-    cur.execute("UPDATE withdraws SET status='approved' WHERE id=?", (w_id,))
-    conn.commit(); conn.close()
+        return jsonify({"ok": False, "errmsg":"not found"}), 404
+    # a rejected withdraw was already refunded, so only a pending one may be paid out
+    cur.execute("UPDATE withdraws SET status='approved' WHERE id=? AND status='pending'", (w_id,))
+    if cur.rowcount == 0:
+        return jsonify({"ok": False, "errmsg":"already processed"}), 400
+    conn.commit()
+    invalidate_cache("withdraws")
     socketio.emit("withdraw_update", {"id": w_id, "status": "approved"}, broadcast=True)
     return jsonify({"ok": True})
 
@@ -452,95 +651,166 @@ def api_admin_withdraws_reject(w_id):
     cur.execute("SELECT * FROM withdraws WHERE id=?", (w_id,))
     w = cur.fetchone()
     if not w:
-        conn.close(); return jsonify({"ok": False, "errmsg":"not found"}), 404
-    # if rejecting — refund to user
-    cur.execute("UPDATE withdraws SET status='rejected' WHERE id=?", (w_id,))
+        return jsonify({"ok": False, "errmsg":"not found"}), 404
+    # if rejecting — refund to user, once, and never after the payout was approved
+    cur.execute("UPDATE withdraws SET status='rejected' WHERE id=? AND status='pending'", (w_id,))
+    if cur.rowcount == 0:
+        return jsonify({"ok": False, "errmsg":"already processed"}), 400
     change_balance(w["uid"], float(w["amount"]))
-    conn.commit(); conn.close()
+    conn.commit()
+    invalidate_cache("withdraws", "users")
     socketio.emit("withdraw_update", {"id": w_id, "status":"rejected"}, broadcast=True)
     return jsonify({"ok": True})
 
 # --------- Admin minimal APIs ----------
 @app.get("/api/admin/dashboard")
 def api_admin_dashboard():
+    # each part only depends on one table, so a new topup does not recount users or tasks
+    users_count = cached("users", "count", lambda: count_rows("SELECT COUNT(*) as cnt FROM users"))
+    tasks_count = cached("tasks", "count", lambda: count_rows("SELECT COUNT(*) as cnt FROM tasks"))
+    topups = cached("topups", "dashboard", lambda: load_money_stats("topups", "topup"))
+    withdraws = cached("withdraws", "dashboard", lambda: load_money_stats("withdraws", "withdraw"))
+    recent = topups["recent"] + withdraws["recent"]
+    pending_count = topups["pending"] + withdraws["pending"]
+    return jsonify({"ok": True, "data":{"usersCount": users_count,"totalRevenue": topups["paid"],"tasksCount": tasks_count,"pendingCount": pending_count,"recentActivity": recent}})
+
+def count_rows(sql):
     conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as cnt FROM users"); users_count = cur.fetchone()["cnt"]
-    cur.execute("SELECT SUM(amount) as s FROM topups WHERE status='paid'"); row = cur.fetchone(); total_revenue = row["s"] or 0
-    cur.execute("SELECT COUNT(*) as cnt FROM tasks"); tasks_count = cur.fetchone()["cnt"]
-    cur.execute("SELECT COUNT(*) as cnt FROM (SELECT id FROM topups WHERE status='pending' UNION SELECT id FROM withdraws WHERE status='pending')"); pending_count = cur.fetchone()["cnt"]
-    # recent
-    recent = []
-    cur.execute("SELECT id, uid, amount, status, created_at FROM topups ORDER BY id DESC LIMIT 5")
-    for r in cur.fetchall():
-        recent.append({"id": r["id"], "type": "topup", "amount": r["amount"], "status": r["status"], "user": r["uid"], "created_at": r["created_at"]})
-    cur.execute("SELECT id, uid, amount, status, created_at FROM withdraws ORDER BY id DESC LIMIT 5")
-    for r in cur.fetchall():
-        recent.append({"id": r["id"], "type":"withdraw", "amount": r["amount"], "status": r["status"], "user": r["uid"], "created_at": r["created_at"]})
-    conn.close()
-    return jsonify({"ok": True, "data":{"usersCount": users_count,"totalRevenue": total_revenue,"tasksCount": tasks_count,"pendingCount": pending_count,"recentActivity": recent}})
+    cur.execute(sql); cnt = cur.fetchone()["cnt"]
+    return cnt
+
+def load_money_stats(table, kind):
+    # table is one of the fixed names above, never user input
+    conn = get_db(); cur = conn.cursor()
+    cur.execute(f"SELECT COALESCE(SUM(CASE WHEN status='paid' THEN amount END), 0) as paid, "
+                f"COUNT(CASE WHEN status='pending' THEN 1 END) as pending FROM {table}")
+    row = cur.fetchone()
+    cur.execute(f"SELECT id, uid, amount, status, created_at FROM {table} ORDER BY id DESC LIMIT 5")
+    recent = [{"id": r["id"], "type": kind, "amount": r["amount"], "status": r["status"], "user": r["uid"], "created_at": r["created_at"]}
+              for r in cur.fetchall()]
+    return {"paid": row["paid"], "pending": row["pending"], "recent": recent}
 
 @app.get("/api/admin/users")
 def api_admin_users():
+    return cached_json("users", "admin", load_admin_users)
+
+def load_admin_users():
     conn = get_db(); cur = conn.cursor()
     cur.execute("SELECT * FROM users")
     users = [dict(x) for x in cur.fetchall()]
-    conn.close()
-    return jsonify({"ok": True, "users": users})
+    return {"ok": True, "users": users}
 
 @app.get("/api/admin/tasks")
 def api_admin_tasks():
+    return cached_json("tasks", "admin", load_admin_tasks)
+
+def load_admin_tasks():
     conn = get_db(); cur = conn.cursor()
     cur.execute("SELECT * FROM tasks ORDER BY id DESC")
     tasks = [dict(x) for x in cur.fetchall()]
-    conn.close()
-    return jsonify({"ok": True, "tasks": tasks})
+    return {"ok": True, "tasks": tasks}
 
 @app.get("/api/admin/topups")
 def api_admin_topups():
+    return cached_json("topups", "admin", load_admin_topups)
+
+def load_admin_topups():
     conn = get_db(); cur = conn.cursor()
     cur.execute("SELECT * FROM topups ORDER BY id DESC")
     items = [dict(x) for x in cur.fetchall()]
-    conn.close()
-    return jsonify({"ok": True, "items": items})
+    return {"ok": True, "items": items}
 
 @app.get("/api/admin/withdraws")
 def api_admin_withdraws():
+    return cached_json("withdraws", "admin", load_admin_withdraws)
+
+def load_admin_withdraws():
     conn = get_db(); cur = conn.cursor()
     cur.execute("SELECT * FROM withdraws ORDER BY id DESC")
     items = [dict(x) for x in cur.fetchall()]
-    conn.close()
-    return jsonify({"ok": True, "items": items})
+    return {"ok": True, "items": items}
 
 # --------- BOT webhook and commands ----------
+# webhook updates are handled by a fixed pool so a burst of updates can't spawn unbounded green threads
+update_queue = eventlet.Queue()
+
+def update_worker():
+    while True:
+        update = update_queue.get()
+        try:
+            # own app context per update: handlers get a fresh db connection, closed on exit
+            with app.app_context():
+                bot.process_new_updates([update])
+        except Exception as e:
+            logger.exception("Failed to handle update: %s", e)
+
+for _ in range(UPDATE_WORKERS):
+    eventlet.spawn_n(update_worker)
+
 @app.post("/bot")
 def bot_webhook_handler():
     try:
-        raw = request.stream.read().decode("utf-8")
-        update = telebot.types.Update.de_json(raw)
-        bot.process_new_updates([update])
+        # parse the raw body once with orjson; de_json accepts the resulting dict as-is
+        update = telebot.types.Update.de_json(orjson.loads(request.get_data()))
+        # answer Telegram right away, handlers (channel checks, replies) run in update_worker
+        update_queue.put(update)
         return "ok"
     except Exception as e:
         logger.exception("Failed to process webhook: %s", e)
         return "err", 500
 
+# positive get_chat_member answers, (user_id, channel) -> expiry; misses are never cached
+# so a user who has just subscribed is let in on the next try
+SUB_CACHE_TTL = 60
+SUB_CACHE_MAX = 10000
+_sub_cache = {}
+
+def remember_subscription(key):
+    now = time()
+    if len(_sub_cache) >= SUB_CACHE_MAX:
+        # sweep expired entries; if all are still live, start over rather than grow
+        for k in [k for k, expiry in _sub_cache.items() if expiry <= now]:
+            del _sub_cache[k]
+        if len(_sub_cache) >= SUB_CACHE_MAX:
+            _sub_cache.clear()
+    _sub_cache[key] = now + SUB_CACHE_TTL
+
 def is_subscribed_to_channel(user_id: int, channel: str) -> bool:
+    key = (user_id, channel)
+    expiry = _sub_cache.get(key)
+    if expiry is not None:
+        if expiry > time():
+            return True
+        _sub_cache.pop(key, None)
     try:
         res = bot.get_chat_member(channel, user_id)
         status = getattr(res, "status", None)
-        return status in ("creator","administrator","member")
+        ok = status in ("creator","administrator","member")
+        if ok:
+            remember_subscription(key)
+        return ok
     except Exception as e:
         logger.warning("subscribe check failed: %s", e)
         return False
 
+def button_markup(text, **kwargs):
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.add(telebot.types.InlineKeyboardButton(text, **kwargs))
+    # serialized once; telebot sends a str reply_markup as-is instead of calling to_json() per message
+    return markup.to_json()
+
+SUBSCRIBE_MARKUP = button_markup("Подписаться", url=f"https://t.me/{REQUIRED_CHANNEL.lstrip('@')}")
+WEBAPP_MARKUP = button_markup("Открыть WebApp", web_app=telebot.types.WebAppInfo(url=WEBAPP_URL))
+ADMIN_MARKUP = button_markup("Открыть Admin", web_app=telebot.types.WebAppInfo(url=WEBAPP_URL + "/admin"))
+MODERATOR_MARKUP = button_markup("Открыть Moderator", web_app=telebot.types.WebAppInfo(url=WEBAPP_URL + "/moderator"))
+
 def check_and_notify_sub(chat_id: int) -> bool:
     try:
         ok = is_subscribed_to_channel(chat_id, REQUIRED_CHANNEL)
         if ok:
             return True
         else:
-            markup = telebot.types.InlineKeyboardMarkup()
-            markup.add(telebot.types.InlineKeyboardButton("Подписаться", url=f"https://t.me/{REQUIRED_CHANNEL.lstrip('@')}"))
-            bot.send_message(chat_id, f"Для доступа подпишитесь на канал {REQUIRED_CHANNEL}", reply_markup=markup)
+            bot.send_message(chat_id, f"Для доступа подпишитесь на канал {REQUIRED_CHANNEL}", reply_markup=SUBSCRIBE_MARKUP)
             return False
     except Exception as e:
         logger.exception("subscribe check failed: %s", e)
@@ -555,9 +825,7 @@ def cmd_start(message):
     # store user
     ensure_user(str(chat_id), message.from_user.first_name, message.from_user.last_name, message.from_user.username)
     # send webapp button
-    markup = telebot.types.InlineKeyboardMarkup()
-    markup.add(telebot.types.InlineKeyboardButton("Открыть WebApp", web_app=telebot.types.WebAppInfo(url=WEBAPP_URL)))
-    bot.send_message(chat_id, "👋 Привет! Открой личный кабинет ReviewCash:", reply_markup=markup)
+    bot.send_message(chat_id, "👋 Привет! Открой личный кабинет ReviewCash:", reply_markup=WEBAPP_MARKUP)
 
 @bot.message_handler(commands=["admin"])
 def cmd_admin(message):
@@ -567,18 +835,14 @@ def cmd_admin(message):
         return
     if not check_and_notify_sub(chat_id):
         return
-    markup = telebot.types.InlineKeyboardMarkup()
-    markup.add(telebot.types.InlineKeyboardButton("Открыть Admin", web_app=telebot.types.WebAppInfo(url=WEBAPP_URL + "/admin")))
-    bot.send_message(chat_id, "Открой админ-панель:", reply_markup=markup)
+    bot.send_message(chat_id, "Открой админ-панель:", reply_markup=ADMIN_MARKUP)
 
 @bot.message_handler(commands=["mod"])
 def cmd_mod(message):
     chat_id = message.chat.id
     if not check_and_notify_sub(chat_id):
         return
-    markup = telebot.types.InlineKeyboardMarkup()
-    markup.add(telebot.types.InlineKeyboardButton("Открыть Moderator", web_app=telebot.types.WebAppInfo(url=WEBAPP_URL + "/moderator")))
-    bot.send_message(chat_id, "Открой модераторскую панель:", reply_markup=markup)
+    bot.send_message(chat_id, "Открой модераторскую панель:", reply_markup=MODERATOR_MARKUP)
 
 @bot.message_handler(commands=["addadmin"])
 def cmd_addadmin(message):
@@ -594,7 +858,8 @@ def cmd_addadmin(message):
         ensure_user(new_id)
         conn = get_db(); cur = conn.cursor()
         cur.execute("UPDATE users SET role='admin' WHERE id=?", (new_id,))
-        conn.commit(); conn.close()
+        conn.commit()
+        invalidate_cache("users")
         bot.send_message(message.chat.id, f"{new_id} теперь админ (демо).")
     except Exception as e:
         bot.send_message(message.chat.id, "Ошибка: " + str(e))
@@ -613,29 +878,58 @@ def cmd_addmod(message):
         ensure_user(new_id)
         conn = get_db(); cur = conn.cursor()
         cur.execute("UPDATE users SET role='mod' WHERE id=?", (new_id,))
-        conn.commit(); conn.close()
+        conn.commit()
+        invalidate_cache("users")
         bot.send_message(message.chat.id, f"{new_id} теперь модератор (демо).")
     except Exception as e:
         bot.send_message(message.chat.id, "Ошибка: " + str(e))
 
+# only update types some handler consumes; everything else stays on Telegram's side
+ALLOWED_UPDATES = ["message"]
+
+def ensure_webhook(webhook_url):
+    # setWebhook atomically replaces any previous hook, so removeWebhook is never needed;
+    # skip the write entirely when Telegram already points at us
+    info = bot.get_webhook_info()
+    if info.url == webhook_url and info.allowed_updates == ALLOWED_UPDATES:
+        return True
+    return bot.set_webhook(url=webhook_url, allowed_updates=ALLOWED_UPDATES)
+
 # set_webhook endpoint
 @app.get("/set_webhook")
 def set_webhook():
     if not WEBAPP_URL or not WEBAPP_URL.startswith("http"):
         return jsonify({"ok": False, "errmsg":"WEBAPP_URL not configured"}), 400
-    webhook_url = WEBAPP_URL.rstrip("/") + "/bot"
     try:
-        bot.remove_webhook()
-    except Exception:
-        pass
-    try:
-        ok = bot.set_webhook(url=webhook_url)
+        ok = ensure_webhook(WEBHOOK_URL)
         logger.info("set_webhook -> %s", ok)
-        return jsonify({"ok": True, "webhook": webhook_url, "result": ok})
+        return jsonify({"ok": True, "webhook": WEBHOOK_URL, "result": ok})
     except Exception as e:
         logger.exception("set_webhook failed: %s", e)
         return jsonify({"ok": False, "errmsg": str(e)}), 500
 
+def setup_webhook_safe():
+    if not WEBAPP_URL or not WEBAPP_URL.startswith("http"):
+        logger.error("WEBAPP_URL not configured (%r); webhook not set", WEBAPP_URL)
+        return False
+    for attempt in range(1, WEBHOOK_MAX_ATTEMPTS + 1):
+        try:
+            ensure_webhook(WEBHOOK_URL)
+            logger.info("Webhook set to %s", WEBHOOK_URL)
+            return True
+        except Exception as e:
+            # 4xx from the Bot API (bad token, bad url) won't fix itself; only 429 is worth retrying
+            permanent = (isinstance(e, telebot.apihelper.ApiTelegramException)
+                         and 400 <= e.error_code < 500 and e.error_code != 429)
+            if permanent or attempt == WEBHOOK_MAX_ATTEMPTS:
+                logger.exception("Failed to set webhook on start: %s", e)
+                break
+            # capped exponential backoff with jitter so restarting instances don't retry in lockstep
+            backoff = min(60, WEBHOOK_BASE_BACKOFF * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            logger.warning("set_webhook attempt %s/%s failed: %s; retrying in %.1fs", attempt, WEBHOOK_MAX_ATTEMPTS, e, backoff)
+            socketio.sleep(backoff)
+    return False
+
 # socket handlers
 @socketio.on("connect")
 def on_connect():
@@ -645,14 +939,13 @@ def on_connect():
 def on_disconnect():
     logger.info("socket disconnected: %s", request.sid)
 
+# scheduled at import so it also happens under gunicorn; the greenthread only runs once the
+# server is accepting connections, so Telegram never posts to a closed socket, and its
+# retries sleep cooperatively instead of delaying startup
+if USE_WEBHOOK_ON_START:
+    socketio.start_background_task(setup_webhook_safe)
+
 if __name__ == "__main__":
-    if USE_WEBHOOK_ON_START:
-        try:
-            webhook_url = WEBAPP_URL.rstrip("/") + "/bot"
-            bot.remove_webhook()
-            bot.set_webhook(url=webhook_url)
-            logger.info("Webhook set to %s", webhook_url)
-        except Exception as e:
-            logger.exception("Failed to set webhook on start: %s", e)
+    # local development; production runs gunicorn with the eventlet worker (see Procfile)
     logger.info("Starting server on %s:%s", HOST, PORT)
     socketio.run(app, host=HOST, port=PORT)